@@ -1,29 +1,52 @@
 # ai_insights.py
-import pandas as pd
 import numpy as np
-from db import SessionLocal
+from sqlalchemy import DateTime, bindparam, select
+from db import SessionLocal, MarketSnapshot, LatestSnapshot, window_start
 from datetime import datetime, timedelta
 
+# Built once so SQLAlchemy reuses its compiled form on every call
+_trend_stmt = (
+    select(MarketSnapshot.timestamp, MarketSnapshot.pt_price)
+    .where(MarketSnapshot.market_id == bindparam("mid"))
+    .where(MarketSnapshot.timestamp >= window_start(bindparam("mid"), bindparam("cutoff", type_=DateTime)))
+    .order_by(MarketSnapshot.timestamp.asc())
+)
+
+# Current price as of the market's last poll
+_checked_stmt = (
+    select(LatestSnapshot.checked_at, LatestSnapshot.pt_price)
+    .where(LatestSnapshot.market_id == bindparam("mid"))
+)
+
 def simple_trend_insight(market_id, lookback_hours=72):
    
     session = SessionLocal()
-    cutoff = datetime.utcnow() - timedelta(hours=lookback_hours)
-    rows = session.query(__import__("db").MarketSnapshot).filter(
-        __import__("db").MarketSnapshot.market_id == market_id,
-        __import__("db").MarketSnapshot.timestamp >= cutoff
-    ).order_by(__import__("db").MarketSnapshot.timestamp.asc()).all()
-    session.close()
+    try:
+        cutoff = datetime.utcnow() - timedelta(hours=lookback_hours)
+        rows = session.execute(_trend_stmt, {"mid": market_id, "cutoff": cutoff}).all()
+        checked = session.execute(_checked_stmt, {"mid": market_id}).first()
+    finally:
+        session.close()
+
+    # The window's first row may predate the cutoff, so clip it there
+    points = [(max(ts, cutoff), p) for ts, p in rows]
+    if rows and checked and checked.checked_at > rows[-1].timestamp:
+        points.append(tuple(checked))
 
-    if len(rows) < 3:
+    if len(points) < 2:
         return {"insight": "Not enough historical data yet to generate trend insights."}
 
-    df = pd.DataFrame([{"t": r.timestamp, "pt_price": r.pt_price, "sy_price": r.sy_price, "tvl": r.tvl} for r in rows])
+    # Snapshots are not evenly spaced, so fit against elapsed seconds rather than row number
+    priced = [(ts, p) for ts, p in points if p is not None]
+    t = np.fromiter(((ts - points[0][0]).total_seconds() for ts, _ in priced), dtype=np.float64)
+    y = np.fromiter((p for _, p in priced), dtype=np.float64)
    
-    if df["pt_price"].notnull().sum() >= 2:
-        x = np.arange(len(df))
-        y = df["pt_price"].fillna(method='ffill').values
-        coeff = np.polyfit(x,y,1)[0]
-        slope_pct = (coeff / np.mean(y)) * 100
+    if y.size >= 2 and t[-1] > t[0]:
+        # Closed-form least-squares slope, i.e. np.polyfit(t, y, 1)[0], per second
+        dx = t - t.mean()
+        coeff = (dx * (y - y.mean())).sum() / (dx * dx).sum()
+        # Fitted change across the span the points cover, as % of the mean price
+        slope_pct = (coeff * t[-1] / y.mean()) * 100
         if slope_pct > 0.5:
             return {"insight": f"PT price trending up (~{slope_pct:.2f}% slope over last {lookback_hours}h). Consider short-term strategies."}
         elif slope_pct < -0.5:
@@ -1,37 +1,207 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Text
+from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Text, LargeBinary, Index
+from sqlalchemy import event, func, select
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import datetime
+import zstandard
 
 DATABASE_URL = "sqlite:///./pendle_history.db"
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+# WAL lets the MCP/API readers run while the poller writes
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+)
+
+engine = create_engine(
+    DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    pool_size=20,
+    max_overflow=10,
+    pool_timeout=30,
+    pool_pre_ping=True,
+    echo=False
+)
+
+@event.listens_for(engine, "connect")
+def _apply_sqlite_pragmas(dbapi_conn, connection_record):
+    cursor = dbapi_conn.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
 Base = declarative_base()
 
 class MarketSnapshot(Base):
     __tablename__ = "market_snapshots"
+    # Serves market_id = ? AND timestamp range/ORDER BY in either direction
+    __table_args__ = (Index("ix_ms_mkt_ts_asc", "market_id", "timestamp"),)
     id = Column(Integer, primary_key=True, index=True)
-    market_id = Column(String, index=True)
-    timestamp = Column(DateTime, default=datetime.datetime.utcnow, index=True)
-    raw_json = Column(Text)  # full JSON payload as string
+    market_id = Column(String)
+    timestamp = Column(DateTime, default=datetime.datetime.utcnow)
+    raw_json = Column(Text)  # legacy uncompressed payload, NULL for new rows
+    raw_json_zstd = Column(LargeBinary)  # full JSON payload, zstd-compressed
     # optional extracted fields
+    name = Column(String)
     pt_price = Column(Float, nullable=True)
     sy_price = Column(Float, nullable=True)
     tvl = Column(Float, nullable=True)
+    content_hash = Column(String(16), nullable=True)  # xxh3_64 of the payload
+
+class LatestSnapshot(Base):
+    """Newest snapshot per market, kept current by the trg_ms_latest trigger"""
+    __tablename__ = "latest_snapshots"
+    market_id = Column(String, primary_key=True)
+    snapshot_id = Column(Integer)  # market_snapshots.id of the newest row
+    timestamp = Column(DateTime)
+    name = Column(String, nullable=True)
+    pt_price = Column(Float, nullable=True)
+    sy_price = Column(Float, nullable=True)
+    tvl = Column(Float, nullable=True)
+    content_hash = Column(String(16), nullable=True)
+    # Last poll that saw this market, whether or not its payload changed
+    checked_at = Column(DateTime)
+
+# Columns copied as-is from market_snapshots into latest_snapshots
+LATEST_COLUMNS = ("timestamp", "name", "pt_price", "sy_price", "tvl", "content_hash")
+
+LATEST_TRIGGER_SQL = f"""
+    CREATE TRIGGER trg_ms_latest AFTER INSERT ON market_snapshots
+    BEGIN
+        INSERT INTO latest_snapshots (market_id, snapshot_id, {", ".join(LATEST_COLUMNS)}, checked_at)
+        VALUES (NEW.market_id, NEW.id, {", ".join("NEW." + c for c in LATEST_COLUMNS)}, NEW.timestamp)
+        ON CONFLICT(market_id) DO UPDATE SET
+            snapshot_id = excluded.snapshot_id,
+            {", ".join(f"{c} = excluded.{c}" for c in LATEST_COLUMNS)},
+            checked_at = excluded.checked_at
+        WHERE excluded.timestamp >= latest_snapshots.timestamp;
+    END
+"""
+
+LATEST_BACKFILL_SQL = f"""
+    INSERT OR REPLACE INTO latest_snapshots (market_id, snapshot_id, {", ".join(LATEST_COLUMNS)}, checked_at)
+    SELECT market_id, id, {", ".join(LATEST_COLUMNS)}, timestamp
+    FROM (
+        SELECT *, ROW_NUMBER() OVER (
+            PARTITION BY market_id ORDER BY timestamp DESC
+        ) AS rn
+        FROM market_snapshots
+    )
+    WHERE rn = 1
+"""
+
+# Indexes on databases created by older versions: superseded by
+# ix_ms_mkt_ts_asc (market_id is its leading column), or never used by a query (name)
+DROPPED_INDEXES = (
+    "ix_market_snapshots_timestamp",
+    "ix_market_snapshots_market_id",
+    "ix_ms_mkt_ts",
+    "ix_market_snapshots_name",
+)
+
+def _add_missing_columns(conn, model):
+    """ALTER TABLE in columns added to `model` since the table was created"""
+    table = model.__tablename__
+    existing = {row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({table})")}
+    added = []
+    for column in model.__table__.columns:
+        if column.name not in existing:
+            col_type = column.type.compile(dialect=conn.dialect)
+            conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column.name} {col_type}")
+            added.append(column.name)
+    return added
 
 def create_db():
     Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        if "name" in _add_missing_columns(conn, MarketSnapshot):
+            conn.exec_driver_sql("UPDATE market_snapshots SET name = json_extract(raw_json, '$.name')")
+        latest_added = _add_missing_columns(conn, LatestSnapshot)
+        for name in DROPPED_INDEXES:
+            conn.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+        has_trigger = conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'trg_ms_latest'"
+        ).first()
+        if not has_trigger or latest_added:
+            # Seed latest_snapshots from existing history
+            conn.exec_driver_sql(LATEST_BACKFILL_SQL)
+        # Recreate so the trigger always copies the current LATEST_COLUMNS
+        conn.exec_driver_sql("DROP TRIGGER IF EXISTS trg_ms_latest")
+        conn.exec_driver_sql(LATEST_TRIGGER_SQL)
+    # create_all skips existing tables, so add any newer indexes by hand
+    for index in MarketSnapshot.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+
+ZSTD_LEVEL = 3
+
+def compress_json(raw_json, compressor=None):
+    """zstd-compress a JSON payload (str or bytes) for the raw_json_zstd column"""
+    if isinstance(raw_json, str):
+        raw_json = raw_json.encode()
+    compressor = compressor or zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+    return compressor.compress(raw_json)
+
+def load_raw_json(raw_json, raw_json_zstd):
+    """Return a snapshot's JSON payload (bytes, or str for legacy rows)"""
+    if raw_json_zstd is not None:
+        return zstandard.ZstdDecompressor().decompress(raw_json_zstd)
+    return raw_json
+
+def window_start(market_id, cutoff):
+    """
+    Start of a history window as a scalar subquery: the newest snapshot at or
+    before `cutoff`, else `cutoff`. Unchanged polls are not stored, so this row
+    carries the value that was current when the window opened.
+    """
+    return select(func.coalesce(func.max(MarketSnapshot.timestamp), cutoff)).where(
+        MarketSnapshot.market_id == market_id,
+        MarketSnapshot.timestamp <= cutoff
+    ).scalar_subquery()
 
-def save_snapshot(session, market_id, raw_json, pt_price=None, sy_price=None, tvl=None):
+# window_start() for raw sqlite3 callers; binds :market_id and :cutoff
+WINDOW_START_SQL = """
+    SELECT COALESCE(MAX(timestamp), :cutoff)
+    FROM market_snapshots
+    WHERE market_id = :market_id AND timestamp <= :cutoff
+"""
+
+def save_snapshot(session, market_id, raw_json, name=None, pt_price=None, sy_price=None, tvl=None):
     snap = MarketSnapshot(
         market_id=market_id,
-        raw_json=raw_json,
+        raw_json_zstd=compress_json(raw_json),
+        name=name,
         pt_price=pt_price,
         sy_price=sy_price,
         tvl=tvl
     )
     session.add(snap)
     session.commit()
-    session.refresh(snap)
     return snap
+
+def get_latest_hashes(session):
+    """Map market_id -> content_hash of each market's newest snapshot"""
+    return dict(session.query(LatestSnapshot.market_id, LatestSnapshot.content_hash).all())
+
+def mark_checked(session, market_ids, checked_at):
+    """Record that a poll saw these markets unchanged; committed with the poll's snapshots"""
+    if market_ids:
+        session.query(LatestSnapshot).filter(
+            LatestSnapshot.market_id.in_(market_ids)
+        ).update({LatestSnapshot.checked_at: checked_at}, synchronize_session=False)
+
+def save_snapshots_bulk(session, snaps):
+    """Insert a batch of snapshot dicts and commit the poll in a single transaction"""
+    compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+    rows = []
+    for snap in snaps:
+        row = dict(snap)
+        row["raw_json_zstd"] = compress_json(row.pop("raw_json"), compressor)
+        rows.append(row)
+    if rows:
+        session.bulk_insert_mappings(MarketSnapshot, rows)
+    session.commit()
+    return len(rows)
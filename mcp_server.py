@@ -4,7 +4,7 @@ Provides tools for querying Pendle market data, analytics, and insights
 """
 
 import asyncio
-import json
+import orjson
 from datetime import datetime, timedelta
 from typing import Optional, List
 import sqlite3
@@ -14,9 +14,34 @@ from mcp.server import Server
 from mcp.types import Tool, TextContent
 import mcp.server.stdio
 
+from db import SQLITE_PRAGMAS, WINDOW_START_SQL, load_raw_json
+
+# Tables and columns the tools read that databases from older versions lack
+REQUIRED_SCHEMA = {
+    "market_snapshots": ("name", "raw_json_zstd"),
+    "latest_snapshots": ("market_id", "name", "pt_price", "sy_price", "tvl", "timestamp", "checked_at"),
+}
+
 # Database helper
+_conn = None
+
+def check_schema(conn):
+    """Fail with a clear message if the database has not been migrated by db.create_db()"""
+    for table, columns in REQUIRED_SCHEMA.items():
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        missing = [c for c in columns if c not in existing]
+        if missing:
+            raise RuntimeError(
+                f"Database schema is out of date ({table} is missing {', '.join(missing)}). "
+                "Run create_db() by starting poller.py or server.py once, then retry."
+            )
+
 def get_db_connection():
-    """Get database connection"""
+    """Get the shared database connection, opening it on first use"""
+    global _conn
+    if _conn is not None:
+        return _conn
+    
     script_dir = os.path.dirname(os.path.abspath(__file__))
     db_path = os.path.join(script_dir, "pendle_history.db")
     
@@ -24,10 +49,31 @@ def get_db_connection():
     if not os.path.exists(db_path):
         raise FileNotFoundError(f"Database not found at: {db_path}")
     
-    conn = sqlite3.connect(db_path)
+    conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
     conn.row_factory = sqlite3.Row
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    try:
+        check_schema(conn)
+    except RuntimeError:
+        conn.close()
+        raise
+    _conn = conn
     return conn
 
+def iter_dict_rows(cursor, size: int = 256):
+    """Yield query results as dicts, fetching `size` rows at a time"""
+    while chunk := cursor.fetchmany(size):
+        yield from (dict(row) for row in chunk)
+
+def utc_cutoff(hours) -> str:
+    """Window start as stored by SQLAlchemy: naive UTC, space-separated, with microseconds"""
+    return (datetime.utcnow() - timedelta(hours=hours)).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+def to_json_text(obj) -> str:
+    """Serialize a tool result as indented JSON text"""
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+
 # Initialize MCP server
 app = Server("pendle-mcp-server")
 
@@ -178,37 +224,20 @@ async def get_all_markets() -> list[TextContent]:
     cursor = conn.cursor()
     
     # Get latest snapshot for each market
-    query = """
-        SELECT m1.*
-        FROM market_snapshots m1
-        INNER JOIN (
-            SELECT market_id, MAX(timestamp) as max_ts
-            FROM market_snapshots
-            GROUP BY market_id
-        ) m2 ON m1.market_id = m2.market_id AND m1.timestamp = m2.max_ts
-    """
-    
-    cursor.execute(query)
+    cursor.execute("""
+        SELECT market_id, name, pt_price, sy_price, tvl, checked_at
+        FROM latest_snapshots
+    """)
     rows = cursor.fetchall()
     
-    markets = []
-    for row in rows:
-        try:
-            raw_data = json.loads(row['raw_json'])
-            market_name = raw_data.get('name', 'Unknown')
-        except:
-            market_name = 'Unknown'
-        
-        markets.append({
-            "market_id": row['market_id'],
-            "name": market_name,
-            "pt_price": row['pt_price'],
-            "sy_price": row['sy_price'],
-            "tvl": row['tvl'],
-            "last_updated": row['timestamp']
-        })
-    
-    conn.close()
+    markets = [{
+        "market_id": row['market_id'],
+        "name": row['name'] or 'Unknown',
+        "pt_price": row['pt_price'],
+        "sy_price": row['sy_price'],
+        "tvl": row['tvl'],
+        "last_updated": row['checked_at']
+    } for row in rows]
     
     result = {
         "count": len(markets),
@@ -217,7 +246,7 @@ async def get_all_markets() -> list[TextContent]:
     
     return [TextContent(
         type="text",
-        text=json.dumps(result, indent=2)
+        text=to_json_text(result)
     )]
 
 async def get_market_details(market_id: str) -> list[TextContent]:
@@ -226,21 +255,21 @@ async def get_market_details(market_id: str) -> list[TextContent]:
     cursor = conn.cursor()
     
     cursor.execute("""
-        SELECT * FROM market_snapshots 
+        SELECT market_id, timestamp, pt_price, sy_price, tvl, raw_json, raw_json_zstd
+        FROM market_snapshots
         WHERE market_id = ? 
         ORDER BY timestamp DESC 
         LIMIT 1
     """, (market_id,))
     
     row = cursor.fetchone()
-    conn.close()
     
     if not row:
         return [TextContent(type="text", text=f"Market {market_id} not found")]
     
     try:
-        full_data = json.loads(row['raw_json'])
-    except:
+        full_data = orjson.loads(load_raw_json(row['raw_json'], row['raw_json_zstd']))
+    except orjson.JSONDecodeError:
         full_data = {}
     
     result = {
@@ -252,37 +281,35 @@ async def get_market_details(market_id: str) -> list[TextContent]:
         "full_data": full_data
     }
     
-    return [TextContent(type="text", text=json.dumps(result, indent=2))]
+    return [TextContent(type="text", text=to_json_text(result))]
 
 async def get_market_history(market_id: str, hours: int = 24) -> list[TextContent]:
     """Get historical data for a market"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    cutoff = (datetime.now() - timedelta(hours=hours)).isoformat()
+    cutoff = utc_cutoff(hours)
     
-    cursor.execute("""
-        SELECT timestamp, pt_price, sy_price, tvl
+    # MAX(timestamp, :cutoff) reports a carried-in first row at the cutoff
+    cursor.execute(f"""
+        SELECT MAX(timestamp, :cutoff) AS timestamp, pt_price, sy_price, tvl
         FROM market_snapshots
-        WHERE market_id = ? AND timestamp >= ?
-        ORDER BY timestamp ASC
-    """, (market_id, cutoff))
+        WHERE market_id = :market_id AND timestamp >= ({WINDOW_START_SQL})
+        ORDER BY market_snapshots.timestamp ASC
+    """, {"market_id": market_id, "cutoff": cutoff})
     
-    rows = cursor.fetchall()
-    conn.close()
+    history = list(iter_dict_rows(cursor))
     
-    if not rows:
+    if not history:
         return [TextContent(type="text", text=f"No history found for market {market_id}")]
     
-    history = [dict(row) for row in rows]
-    
     result = {
         "market_id": market_id,
         "data_points": len(history),
         "history": history
     }
     
-    return [TextContent(type="text", text=json.dumps(result, indent=2))]
+    return [TextContent(type="text", text=to_json_text(result))]
 
 async def get_top_markets(limit: int = 5) -> list[TextContent]:
     """Get top markets by TVL"""
@@ -290,20 +317,14 @@ async def get_top_markets(limit: int = 5) -> list[TextContent]:
     cursor = conn.cursor()
     
     query = """
-        SELECT m1.*, json_extract(m1.raw_json, '$.name') as name
-        FROM market_snapshots m1
-        INNER JOIN (
-            SELECT market_id, MAX(timestamp) as max_ts
-            FROM market_snapshots
-            GROUP BY market_id
-        ) m2 ON m1.market_id = m2.market_id AND m1.timestamp = m2.max_ts
-        ORDER BY m1.tvl DESC
+        SELECT market_id, name, tvl, pt_price, sy_price
+        FROM latest_snapshots
+        ORDER BY tvl DESC
         LIMIT ?
     """
     
     cursor.execute(query, (limit,))
     rows = cursor.fetchall()
-    conn.close()
     
     top_markets = []
     for row in rows:
@@ -315,39 +336,26 @@ async def get_top_markets(limit: int = 5) -> list[TextContent]:
             "sy_price": row['sy_price']
         })
     
-    return [TextContent(type="text", text=json.dumps({"top_markets": top_markets}, indent=2))]
+    return [TextContent(type="text", text=to_json_text({"top_markets": top_markets}))]
 
 async def get_analytics_summary() -> list[TextContent]:
     """Get overall analytics"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    # Total markets
-    cursor.execute("SELECT COUNT(DISTINCT market_id) FROM market_snapshots")
-    total_markets = cursor.fetchone()[0]
+    # One row per market, so the aggregates run over latest_snapshots
+    cursor.execute("""
+        SELECT COUNT(*) AS total_markets,
+               TOTAL(tvl) AS total_tvl,
+               COALESCE(TOTAL(pt_price) / NULLIF(COUNT(*), 0), 0) AS avg_pt_price
+        FROM latest_snapshots
+    """)
+    total_markets, total_tvl, avg_pt_price = cursor.fetchone()
     
     # Total snapshots
     cursor.execute("SELECT COUNT(*) FROM market_snapshots")
     total_snapshots = cursor.fetchone()[0]
     
-    # Get latest snapshots for aggregation
-    query = """
-        SELECT m1.tvl, m1.pt_price
-        FROM market_snapshots m1
-        INNER JOIN (
-            SELECT market_id, MAX(timestamp) as max_ts
-            FROM market_snapshots
-            GROUP BY market_id
-        ) m2 ON m1.market_id = m2.market_id AND m1.timestamp = m2.max_ts
-    """
-    
-    cursor.execute(query)
-    rows = cursor.fetchall()
-    conn.close()
-    
-    total_tvl = sum(row['tvl'] for row in rows if row['tvl'])
-    avg_pt_price = sum(row['pt_price'] for row in rows if row['pt_price']) / len(rows) if rows else 0
-    
     result = {
         "total_markets": total_markets,
         "total_tvl": total_tvl,
@@ -356,7 +364,7 @@ async def get_analytics_summary() -> list[TextContent]:
         "timestamp": datetime.now().isoformat()
     }
     
-    return [TextContent(type="text", text=json.dumps(result, indent=2))]
+    return [TextContent(type="text", text=to_json_text(result))]
 
 async def compare_markets(market_ids: List[str]) -> list[TextContent]:
     """Compare multiple markets"""
@@ -365,19 +373,13 @@ async def compare_markets(market_ids: List[str]) -> list[TextContent]:
     
     placeholders = ','.join('?' * len(market_ids))
     query = f"""
-        SELECT m1.*, json_extract(m1.raw_json, '$.name') as name
-        FROM market_snapshots m1
-        INNER JOIN (
-            SELECT market_id, MAX(timestamp) as max_ts
-            FROM market_snapshots
-            WHERE market_id IN ({placeholders})
-            GROUP BY market_id
-        ) m2 ON m1.market_id = m2.market_id AND m1.timestamp = m2.max_ts
+        SELECT market_id, name, pt_price, sy_price, tvl, timestamp
+        FROM latest_snapshots
+        WHERE market_id IN ({placeholders})
     """
     
     cursor.execute(query, market_ids)
     rows = cursor.fetchall()
-    conn.close()
     
     comparison = []
     for row in rows:
@@ -390,31 +392,36 @@ async def compare_markets(market_ids: List[str]) -> list[TextContent]:
             "timestamp": row['timestamp']
         })
     
-    return [TextContent(type="text", text=json.dumps({"comparison": comparison}, indent=2))]
+    return [TextContent(type="text", text=to_json_text({"comparison": comparison}))]
 
 async def calculate_price_change(market_id: str, hours: int = 24) -> list[TextContent]:
     """Calculate price change over time"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    cutoff = (datetime.now() - timedelta(hours=hours)).isoformat()
+    cutoff = utc_cutoff(hours)
     
-    cursor.execute("""
-        SELECT pt_price, sy_price, timestamp
+    # The end of the window is the market's current state as of its last poll
+    last = cursor.execute("""
+        SELECT pt_price, sy_price, checked_at AS timestamp
+        FROM latest_snapshots
+        WHERE market_id = ?
+    """, (market_id,)).fetchone()
+    
+    # The start is the first row of the window, clipped to the cutoff; one seek on ix_ms_mkt_ts_asc
+    first = cursor.execute(f"""
+        SELECT pt_price, sy_price, MAX(timestamp, :cutoff) AS timestamp
         FROM market_snapshots
-        WHERE market_id = ? AND timestamp >= ?
-        ORDER BY timestamp ASC
-    """, (market_id, cutoff))
+        WHERE market_id = :market_id AND timestamp >= ({WINDOW_START_SQL})
+        ORDER BY market_snapshots.timestamp ASC
+        LIMIT 1
+    """, {"market_id": market_id, "cutoff": cutoff}).fetchone()
     
-    rows = cursor.fetchall()
-    conn.close()
+    start_time = first['timestamp'] if first else None
     
-    if len(rows) < 2:
+    if last is None or start_time is None or start_time >= last['timestamp']:
         return [TextContent(type="text", text=f"Insufficient data to calculate price change for {market_id}")]
     
-    first = rows[0]
-    last = rows[-1]
-    
     pt_change = ((last['pt_price'] - first['pt_price']) / first['pt_price'] * 100) if first['pt_price'] else 0
     sy_change = ((last['sy_price'] - first['sy_price']) / first['sy_price'] * 100) if first['sy_price'] else 0
     
@@ -423,13 +430,13 @@ async def calculate_price_change(market_id: str, hours: int = 24) -> list[TextCo
         "time_period_hours": hours,
         "pt_price_change_percent": round(pt_change, 4),
         "sy_price_change_percent": round(sy_change, 4),
-        "start_time": first['timestamp'],
+        "start_time": start_time,
         "end_time": last['timestamp'],
         "start_pt_price": first['pt_price'],
         "end_pt_price": last['pt_price']
     }
     
-    return [TextContent(type="text", text=json.dumps(result, indent=2))]
+    return [TextContent(type="text", text=to_json_text(result))]
 
 # ==================== MAIN ====================
 
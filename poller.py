@@ -1,127 +1,220 @@
 # poller.py - Fixed with correct API structure
-import requests
-import os
+import aiohttp
+import asyncio
 import json
-from apscheduler.schedulers.background import BackgroundScheduler
-from db import SessionLocal, save_snapshot
+import os
+import orjson
+import xxhash
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from db import SessionLocal, create_db, get_latest_hashes, mark_checked, save_snapshots_bulk
 from datetime import datetime
-import time
 
 PENDLE_BASE = "https://api-v2.pendle.finance/core"
 POLL_INTERVAL_SECONDS = int(os.getenv("POLL_INTERVAL_SECONDS", "300"))
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "16"))
+MAX_MARKETS = int(os.getenv("MAX_MARKETS", "10"))
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(connect=3, sock_read=20)
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 0.5
+# Transport, HTTP status and malformed-body failures from a single fetch
+FETCH_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, ValueError)
+
+_http_session = None
+
+def get_http_session():
+    """Shared keep-alive session so polls reuse TCP/TLS connections to Pendle"""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, limit_per_host=MAX_CONCURRENT_REQUESTS),
+            timeout=REQUEST_TIMEOUT,
+        )
+    return _http_session
+
+async def close_http_session():
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+
+# url -> (ETag, Last-Modified, parsed body) from the last 200 response
+_http_cache = {}
+
+async def _request_json(session, url, headers=None):
+    """GET a URL, retrying rate limits and transient errors; returns (status, headers, body)"""
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            async with session.get(url, headers=headers) as r:
+                if r.status == 304:
+                    return r.status, r.headers, None
+                if r.status not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                    r.raise_for_status()
+                    return r.status, r.headers, await r.json()
+        except aiohttp.ClientConnectionError:
+            if attempt == MAX_RETRIES:
+                raise
+        await asyncio.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
+
+async def get_json(session, url):
+    """GET a URL and decode its JSON"""
+    _, _, body = await _request_json(session, url)
+    return body
+
+async def get_json_if_modified(session, url):
+    """
+    Conditional GET using the validators from the last response.
+    Returns (body, modified); on 304 the cached body is reused without re-parsing.
+    """
+    headers = {}
+    cached = _http_cache.get(url)
+    if cached:
+        etag, last_modified, _ = cached
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+    
+    status, resp_headers, body = await _request_json(session, url, headers)
+    if status == 304 and cached:
+        return cached[2], False
+    
+    etag = resp_headers.get("ETag")
+    last_modified = resp_headers.get("Last-Modified")
+    if etag or last_modified:
+        _http_cache[url] = (etag, last_modified, body)
+    return body, True
 
-def fetch_all_markets():
-    """Fetch all markets - v1 endpoint works"""
+async def fetch_all_markets(session):
+    """Fetch all markets - v1 endpoint works. A 304 reuses the cached list"""
     url = f"{PENDLE_BASE}/v1/1/markets"
     print(f"📡 Fetching markets from: {url}")
     
     try:
-        r = requests.get(url, timeout=20)
-        r.raise_for_status()
-        data = r.json()
+        data, modified = await get_json_if_modified(session, url)
+        if not modified:
+            print("✅ Markets unchanged since last poll (304), reusing cached list")
+            return data
         print(f"✅ Successfully fetched {len(data.get('results', []))} markets")
         return data
-    except Exception as e:
+    except FETCH_ERRORS as e:
         print(f"❌ Error fetching markets: {e}")
         return {"results": []}
 
-def fetch_market_data_v1(chain_id, market_address):
+async def fetch_market_data_v1(session, semaphore, chain_id, market_address):
     """
     Try v1 endpoint for market details
     The v1 endpoint structure includes the data we need
     """
     url = f"{PENDLE_BASE}/v1/{chain_id}/markets/{market_address}"
-    print(f"📊 Fetching from v1: {market_address[:10]}...")
     
+    async with semaphore:
+        print(f"📊 Fetching from v1: {market_address[:10]}...")
+        try:
+            return await get_json(session, url)
+        except FETCH_ERRORS as e:
+            print(f"   v1 failed: {e}")
+            return None
+
+def extract_prices(market):
+    """Pull (pt_price, sy_price, tvl) out of a market payload"""
+    return (
+        (market.get("pt") or {}).get("price", {}).get("usd"),
+        (market.get("sy") or {}).get("price", {}).get("usd"),
+        (market.get("liquidity") or {}).get("usd"),
+    )
+
+def dump_payload(raw):
+    """Serialize a payload with sorted keys, so its hash only changes when the content does"""
     try:
-        r = requests.get(url, timeout=20)
-        r.raise_for_status()
-        return r.json()
-    except Exception as e:
-        print(f"   v1 failed: {e}")
-        return None
+        return orjson.dumps(raw, option=orjson.OPT_SORT_KEYS)
+    except TypeError:
+        # orjson rejects integers beyond 64 bits, which aiohttp's json parser accepts
+        return json.dumps(raw, sort_keys=True).encode()
 
-def poll_and_store():
+async def poll_and_store():
     """Main polling function"""
     print("\n" + "="*60)
     print(f"🔄 Starting poll at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     print("="*60)
     
     session = SessionLocal()
-    stored_count = 0
+    snapshots = []
     
     try:
+        http = get_http_session()
         # Get all markets
-        markets_response = fetch_all_markets()
+        # Even on a 304, the detail fallbacks below are fetched fresh and
+        # the content hashes decide what gets stored
+        markets_response = await fetch_all_markets(http)
         markets = markets_response.get("results", [])
         
         if not markets:
             print("⚠️  No markets found!")
             return
         
-        print(f"\n📋 Processing {min(len(markets), 10)} markets...")
+        markets = [m for m in markets[:MAX_MARKETS] if m.get("address")]
+        print(f"\n📋 Processing {len(markets)} markets...")
         
-        # Process markets - let's try more to find data
-        for idx, market in enumerate(markets[:10], 1):
-            market_address = market.get("address")
-            chain_id = market.get("chainId", 1)
-            market_name = market.get("name", "Unknown")
-            
-            if not market_address:
-                continue
+        # The market list response already contains some data!
+        # Let's use that instead of making another API call.
+        # One pass over the list gives the price columns for every market.
+        prices = list(map(extract_prices, markets))
+        
+        # Fetch detailed data as backup, concurrently for every market
+        # that came back without any prices
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        missing = [i for i, p in enumerate(prices) if not any(p)]
+        details = await asyncio.gather(*(
+            fetch_market_data_v1(
+                http, semaphore, markets[i].get("chainId", 1), markets[i]["address"]
+            )
+            for i in missing
+        ))
+        
+        raw_markets = list(markets)
+        for i, detail in zip(missing, details):
+            if detail:
+                prices[i] = extract_prices(detail)
+                raw_markets[i] = detail  # Use detailed data
+        
+        latest_hashes = get_latest_hashes(session)
+        unchanged = []
+        
+        for idx, (market, raw, (pt_price, sy_price, tvl)) in enumerate(
+            zip(markets, raw_markets, prices), 1
+        ):
+            market_address = market["address"]
             
-            print(f"\n[{idx}/10] {market_name}")
+            print(f"\n[{idx}/{len(markets)}] {market.get('name', 'Unknown')}")
             print(f"    Address: {market_address}")
-            print(f"    Chain: {chain_id}")
-            
-            # The market list response already contains some data!
-            # Let's use that instead of making another API call
-            pt_price = None
-            sy_price = None
-            tvl = None
-            
-            # Extract from the market object itself
-            if "pt" in market:
-                pt_price = market["pt"].get("price", {}).get("usd")
-            
-            if "sy" in market:
-                sy_price = market["sy"].get("price", {}).get("usd")
-            
-            if "liquidity" in market:
-                tvl = market["liquidity"].get("usd")
-            
-            # Try fetching detailed data as backup
-            if not pt_price and not sy_price and not tvl:
-                details = fetch_market_data_v1(chain_id, market_address)
-                if details:
-                    if "pt" in details:
-                        pt_price = details["pt"].get("price", {}).get("usd")
-                    if "sy" in details:
-                        sy_price = details["sy"].get("price", {}).get("usd")
-                    if "liquidity" in details:
-                        tvl = details["liquidity"].get("usd")
-                    market = details  # Use detailed data
-            
+            print(f"    Chain: {market.get('chainId', 1)}")
             print(f"    💰 PT Price: ${pt_price if pt_price else 'N/A'}")
             print(f"    💰 SY Price: ${sy_price if sy_price else 'N/A'}")
             print(f"    💵 TVL: ${tvl if tvl else 'N/A'}")
             
-            # Save even if some values are None
-            save_snapshot(
-                session=session,
-                market_id=market_address,
-                raw_json=json.dumps(market),
-                pt_price=pt_price,
-                sy_price=sy_price,
-                tvl=tvl
-            )
+            raw_json = dump_payload(raw)
+            content_hash = xxhash.xxh3_64(raw_json).hexdigest()
+            if latest_hashes.get(market_address) == content_hash:
+                unchanged.append(market_address)
+                print("    ⏭️  Unchanged since last snapshot, skipped")
+                continue
             
-            stored_count += 1
-            print(f"    ✅ Saved to database")
-            time.sleep(0.5)
+            # Save even if some values are None
+            snapshots.append({
+                "market_id": market_address,
+                "raw_json": raw_json,
+                "name": raw.get("name"),
+                "pt_price": pt_price,
+                "sy_price": sy_price,
+                "tvl": tvl,
+                "content_hash": content_hash
+            })
+        
+        # One transaction for the whole poll; skipped markets still get a checked_at
+        mark_checked(session, unchanged, datetime.utcnow())
+        stored_count = save_snapshots_bulk(session, snapshots)
         
         print(f"\n{'='*60}")
-        print(f"✅ Poll completed! Stored {stored_count} market snapshots")
+        print(f"✅ Poll completed! Stored {stored_count} market snapshots ({len(unchanged)} unchanged)")
         print(f"{'='*60}\n")
         
     except Exception as e:
@@ -132,26 +225,34 @@ def poll_and_store():
         session.close()
 
 def start_scheduler():
-    """Start background scheduler"""
-    scheduler = BackgroundScheduler()
+    """Start asyncio scheduler on the running event loop"""
+    scheduler = AsyncIOScheduler()
     scheduler.add_job(poll_and_store, "interval", seconds=POLL_INTERVAL_SECONDS)
     scheduler.start()
     print(f"⏰ Scheduler started - polling every {POLL_INTERVAL_SECONDS} seconds")
+    return scheduler
 
-if __name__ == "__main__":
-    print("🚀 Pendle MCP Poller Starting...")
-    print(f"📍 API Base: {PENDLE_BASE}")
-    print(f"⏱️  Poll Interval: {POLL_INTERVAL_SECONDS}s\n")
+async def main():
+    create_db()
     
     # Run immediately
-    poll_and_store()
+    await poll_and_store()
     
     # Start scheduler
     start_scheduler()
     
     # Keep running
     try:
-        while True:
-            time.sleep(10)
+        await asyncio.Event().wait()
+    finally:
+        await close_http_session()
+
+if __name__ == "__main__":
+    print("🚀 Pendle MCP Poller Starting...")
+    print(f"📍 API Base: {PENDLE_BASE}")
+    print(f"⏱️  Poll Interval: {POLL_INTERVAL_SECONDS}s\n")
+    
+    try:
+        asyncio.run(main())
     except KeyboardInterrupt:
         print("\n👋 Shutting down poller...")
@@ -1,14 +1,32 @@
 # server.py - FastAPI server for Pendle MCP
 from fastapi import FastAPI, Query, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 import uvicorn
-from db import SessionLocal, MarketSnapshot
-from sqlalchemy import func, desc
-from datetime import datetime, timedelta
+from db import SessionLocal, MarketSnapshot, LatestSnapshot, create_db, load_raw_json, window_start
+from sqlalchemy import func, desc, select
+from datetime import datetime, timedelta, timezone
+from itertools import chain
 from typing import Optional, List
-import json
+import orjson
+import os
 
-app = FastAPI(title="Pendle MCP Server", version="1.0.0")
+HISTORY_BATCH_SIZE = 500
+API_WORKERS = int(os.getenv("API_WORKERS", str(max(2, (os.cpu_count() or 2) // 2))))
+
+app = FastAPI(
+    title="Pendle MCP Server",
+    version="1.0.0",
+    default_response_class=ORJSONResponse
+)
+
+# Snapshot timestamps are naive UTC (datetime.utcnow)
+JSON_OPTIONS = orjson.OPT_NAIVE_UTC
+
+def json_response(payload):
+    """Serialize straight to bytes, skipping FastAPI's jsonable_encoder walk"""
+    return Response(orjson.dumps(payload, option=JSON_OPTIONS), media_type="application/json")
 
 # Enable CORS
 app.add_middleware(
@@ -19,51 +37,43 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# History and market lists are repetitive JSON that compresses well
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
 @app.get("/")
-def root():
+async def root():
     """Health check endpoint"""
-    return {
+    return json_response({
         "status": "online",
         "service": "Pendle MCP Server",
-        "timestamp": datetime.now().isoformat()
-    }
+        "timestamp": datetime.now(timezone.utc)
+    })
 
 @app.get("/markets")
 def get_markets():
     """Get list of all tracked markets with latest data"""
     session = SessionLocal()
     try:
-        # Get latest snapshot for each market
-        subquery = session.query(
-            MarketSnapshot.market_id,
-            func.max(MarketSnapshot.timestamp).label('max_ts')
-        ).group_by(MarketSnapshot.market_id).subquery()
-        
-        markets = session.query(MarketSnapshot).join(
-            subquery,
-            (MarketSnapshot.market_id == subquery.c.market_id) &
-            (MarketSnapshot.timestamp == subquery.c.max_ts)
+        # One row per market, kept current on ingest
+        markets = session.query(
+            LatestSnapshot.market_id,
+            LatestSnapshot.name,
+            LatestSnapshot.pt_price,
+            LatestSnapshot.sy_price,
+            LatestSnapshot.tvl,
+            LatestSnapshot.checked_at
         ).all()
         
-        result = []
-        for m in markets:
-            # Parse raw JSON to get market name
-            try:
-                raw_data = json.loads(m.raw_json)
-                market_name = raw_data.get('name', 'Unknown')
-            except:
-                market_name = 'Unknown'
-            
-            result.append({
-                "market_id": m.market_id,
-                "name": market_name,
-                "pt_price": m.pt_price,
-                "sy_price": m.sy_price,
-                "tvl": m.tvl,
-                "last_updated": m.timestamp.isoformat()
-            })
+        result = [{
+            "market_id": m.market_id,
+            "name": m.name or 'Unknown',
+            "pt_price": m.pt_price,
+            "sy_price": m.sy_price,
+            "tvl": m.tvl,
+            "last_updated": m.checked_at
+        } for m in markets]
         
-        return {"count": len(result), "markets": result}
+        return json_response({"count": len(result), "markets": result})
     finally:
         session.close()
 
@@ -72,62 +82,87 @@ def get_market_history(
     market_id: str,
     hours: Optional[int] = Query(24, description="Hours of history to retrieve")
 ):
-    """Get historical data for a specific market"""
+    """Get historical data for a specific market, streamed in batches"""
     session = SessionLocal()
     try:
-        cutoff = datetime.now() - timedelta(hours=hours)
-        
-        snapshots = session.query(MarketSnapshot).filter(
+        # Snapshots are stamped with utcnow, so the cutoff must be UTC too
+        cutoff = datetime.utcnow() - timedelta(hours=hours)
+        
+        stmt = select(
+            MarketSnapshot.timestamp,
+            MarketSnapshot.pt_price,
+            MarketSnapshot.sy_price,
+            MarketSnapshot.tvl
+        ).where(
             MarketSnapshot.market_id == market_id,
-            MarketSnapshot.timestamp >= cutoff
-        ).order_by(MarketSnapshot.timestamp.asc()).all()
+            MarketSnapshot.timestamp >= window_start(market_id, cutoff)
+        ).order_by(MarketSnapshot.timestamp.asc()).execution_options(yield_per=HISTORY_BATCH_SIZE)
+        batches = session.execute(stmt).partitions()
         
-        if not snapshots:
+        # Pull the first batch up front so a market with no snapshots is still a 404
+        first_batch = next(batches, None)
+        if first_batch is None:
             raise HTTPException(status_code=404, detail="Market not found or no data available")
-        
-        history = []
-        for s in snapshots:
-            history.append({
-                "timestamp": s.timestamp.isoformat(),
-                "pt_price": s.pt_price,
-                "sy_price": s.sy_price,
-                "tvl": s.tvl
-            })
-        
-        return {
-            "market_id": market_id,
-            "data_points": len(history),
-            "history": history
-        }
-    finally:
+    except Exception:
         session.close()
+        raise
+    
+    def generate():
+        try:
+            yield b'{"market_id":' + orjson.dumps(market_id) + b',"history":['
+            data_points = 0
+            for batch in chain([first_batch], batches):
+                # Report a carried-in first row at the cutoff, not its original time
+                chunk = b",".join(orjson.dumps({
+                    "timestamp": max(ts, cutoff),
+                    "pt_price": pt,
+                    "sy_price": sy,
+                    "tvl": tvl
+                }, option=JSON_OPTIONS) for ts, pt, sy, tvl in batch)
+                yield (b"," if data_points else b"") + chunk
+                data_points += len(batch)
+            yield b'],"data_points":' + orjson.dumps(data_points) + b"}"
+        finally:
+            session.close()
+    
+    return StreamingResponse(generate(), media_type="application/json")
 
 @app.get("/market/{market_id}/latest")
 def get_market_latest(market_id: str):
     """Get latest snapshot for a specific market"""
     session = SessionLocal()
     try:
-        snapshot = session.query(MarketSnapshot).filter(
-            MarketSnapshot.market_id == market_id
-        ).order_by(desc(MarketSnapshot.timestamp)).first()
+        snapshot = session.execute(
+            select(
+                MarketSnapshot.market_id,
+                MarketSnapshot.timestamp,
+                MarketSnapshot.pt_price,
+                MarketSnapshot.sy_price,
+                MarketSnapshot.tvl,
+                MarketSnapshot.raw_json,
+                MarketSnapshot.raw_json_zstd
+            ).where(
+                MarketSnapshot.market_id == market_id
+            ).order_by(desc(MarketSnapshot.timestamp)).limit(1)
+        ).first()
         
         if not snapshot:
             raise HTTPException(status_code=404, detail="Market not found")
         
         # Parse full data
         try:
-            full_data = json.loads(snapshot.raw_json)
-        except:
+            full_data = orjson.loads(load_raw_json(snapshot.raw_json, snapshot.raw_json_zstd))
+        except orjson.JSONDecodeError:
             full_data = {}
         
-        return {
+        return json_response({
             "market_id": snapshot.market_id,
-            "timestamp": snapshot.timestamp.isoformat(),
+            "timestamp": snapshot.timestamp,
             "pt_price": snapshot.pt_price,
             "sy_price": snapshot.sy_price,
             "tvl": snapshot.tvl,
             "full_data": full_data
-        }
+        })
     finally:
         session.close()
 
@@ -136,34 +171,23 @@ def get_analytics_summary():
     """Get overall analytics summary"""
     session = SessionLocal()
     try:
-        # Total markets tracked
-        total_markets = session.query(func.count(func.distinct(MarketSnapshot.market_id))).scalar()
-        
-        # Total TVL across all markets (latest snapshots)
-        subquery = session.query(
-            MarketSnapshot.market_id,
-            func.max(MarketSnapshot.timestamp).label('max_ts')
-        ).group_by(MarketSnapshot.market_id).subquery()
-        
-        latest_snapshots = session.query(MarketSnapshot).join(
-            subquery,
-            (MarketSnapshot.market_id == subquery.c.market_id) &
-            (MarketSnapshot.timestamp == subquery.c.max_ts)
-        ).all()
-        
-        total_tvl = sum(s.tvl for s in latest_snapshots if s.tvl)
-        avg_pt_price = sum(s.pt_price for s in latest_snapshots if s.pt_price) / len(latest_snapshots) if latest_snapshots else 0
-        
-        # Total data points
-        total_snapshots = session.query(func.count(MarketSnapshot.id)).scalar()
-        
-        return {
+        # Market count, TVL/PT price totals and total data points in one Core statement
+        stmt = select(
+            func.count(LatestSnapshot.market_id),
+            func.total(LatestSnapshot.tvl),
+            func.total(LatestSnapshot.pt_price),
+            select(func.count(MarketSnapshot.id)).scalar_subquery()
+        )
+        total_markets, total_tvl, total_pt_price, total_snapshots = session.execute(stmt).one()
+        avg_pt_price = total_pt_price / total_markets if total_markets else 0
+        
+        return json_response({
             "total_markets": total_markets,
             "total_tvl": total_tvl,
             "average_pt_price": avg_pt_price,
             "total_snapshots": total_snapshots,
-            "timestamp": datetime.now().isoformat()
-        }
+            "timestamp": datetime.now(timezone.utc)
+        })
     finally:
         session.close()
 
@@ -172,38 +196,39 @@ def get_top_markets(limit: int = Query(5, description="Number of top markets to
     """Get top markets by TVL"""
     session = SessionLocal()
     try:
-        subquery = session.query(
-            MarketSnapshot.market_id,
-            func.max(MarketSnapshot.timestamp).label('max_ts')
-        ).group_by(MarketSnapshot.market_id).subquery()
-        
-        top_markets = session.query(MarketSnapshot).join(
-            subquery,
-            (MarketSnapshot.market_id == subquery.c.market_id) &
-            (MarketSnapshot.timestamp == subquery.c.max_ts)
-        ).order_by(desc(MarketSnapshot.tvl)).limit(limit).all()
-        
-        result = []
-        for m in top_markets:
-            try:
-                raw_data = json.loads(m.raw_json)
-                market_name = raw_data.get('name', 'Unknown')
-            except:
-                market_name = 'Unknown'
-            
-            result.append({
-                "market_id": m.market_id,
-                "name": market_name,
-                "tvl": m.tvl,
-                "pt_price": m.pt_price,
-                "sy_price": m.sy_price
-            })
-        
-        return {"top_markets": result}
+        stmt = select(
+            LatestSnapshot.market_id,
+            LatestSnapshot.name,
+            LatestSnapshot.tvl,
+            LatestSnapshot.pt_price,
+            LatestSnapshot.sy_price
+        ).order_by(desc(LatestSnapshot.tvl)).limit(limit)
+        top_markets = session.execute(stmt).all()
+        
+        result = [{
+            "market_id": m.market_id,
+            "name": m.name or 'Unknown',
+            "tvl": m.tvl,
+            "pt_price": m.pt_price,
+            "sy_price": m.sy_price
+        } for m in top_markets]
+        
+        return json_response({"top_markets": result})
     finally:
         session.close()
 
 if __name__ == "__main__":
     print("🚀 Starting Pendle MCP API Server...")
     print("📖 API Docs: http://localhost:8000/docs")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    print(f"👷 Workers: {API_WORKERS}")
+    # Create/migrate the schema once here, not in every worker's startup
+    create_db()
+    # Workers need an import string; uvloop/httptools come from uvicorn[standard]
+    uvicorn.run(
+        "server:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=API_WORKERS,
+        loop="uvloop",
+        http="httptools"
+    )